@@ -1,5 +1,6 @@
 from flask import Flask, render_template, request, jsonify, session, Response, send_file
 import json
+import numpy as np
 import pandas as pd
 from jinja2.runtime import Undefined
 import folium
@@ -8,6 +9,13 @@ from geopy.exc import GeocoderTimedOut
 import requests
 import os
 import secrets
+import hashlib
+import gzip
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from io import StringIO
 
 app = Flask(__name__)
@@ -26,15 +34,118 @@ if not os.path.exists(templates_dir):
 # simple in-memory cache for geocoding (module-level, not persisted)
 geocode_cache = {}
 
+# postcodes.io bulk client
+POSTCODES_IO_URL = "https://api.postcodes.io/postcodes"
+POSTCODES_IO_CHUNK = 100  # API maximum per bulk request
+POSTCODES_IO_WORKERS = 4
+POSTCODES_IO_RETRIES = 4
+POSTCODES_IO_BACKOFF = 0.5  # seconds, doubled per attempt
+POSTCODES_IO_MAX_WAIT = 10  # longer Retry-After: give up on the chunk, use the fallback
+NOMINATIM_MIN_INTERVAL = 1.0  # seconds between calls (Nominatim usage policy)
+# process-wide spacing for fallback calls, shared by all request threads
+nominatim_lock = threading.Lock()
+nominatim_last_call = 0.0
+NOMINATIM_FALLBACK_MAX = 25  # default cap on slow per-postcode fallbacks per bulk call (None = no cap)
+
+# rendered map fragments / JSON payloads, keyed by dataset version (LRU, not persisted)
+fragment_cache = OrderedDict()
+FRAGMENT_CACHE_MAX = 256
+# gzip copies of the above, kept separately so they don't halve its capacity
+gzip_cache = OrderedDict()
+# request threads share the LRU caches; guards lookups vs evictions
+cache_lock = threading.Lock()
+# session records indexed by employee number, per (kind, dataset version)
+record_index_cache = OrderedDict()
+RECORD_INDEX_CACHE_MAX = 8
+
+# annual commute estimates (overridable per request on /api/analytics)
+WORKING_DAYS_PER_YEAR = 225
+CO2_KG_PER_MILE = 0.27  # average UK car, DESNZ conversion factors
+MAX_WORKING_DAYS = 366
+MAX_CO2_KG_PER_MILE = 5.0  # well above any road vehicle; guards against overflow
+ANALYTICS_PERCENTILES = [10, 25, 50, 75, 90, 95]
+analytics_cache = OrderedDict()
+ANALYTICS_CACHE_MAX = 64
+
+# OSRM /table batching for catchment analysis (public server caps a table at 100 coordinates)
+OSRM_TABLE_URLS = [
+    "http://127.0.0.1:5000/table/v1/driving/",  # local OSRM default
+    "https://router.project-osrm.org/table/v1/driving/"
+]
+OSRM_TABLE_MAX_COORDS = 100
+OSRM_TABLE_WORKERS = 4
+CATCHMENT_BANDS = [30, 45, 60]
+CATCHMENT_MAX_DESTINATIONS = 20
+catchment_cache = OrderedDict()
+CATCHMENT_CACHE_MAX = 128
+
 
 def _pc_norm(s):
     return None if pd.isna(s) else str(s).strip().upper()
 
-def fetch_postcodes_bulk(postcodes):
+def _post_postcodes_chunk(s, chunk, retries=POSTCODES_IO_RETRIES):
+    """POST one chunk to postcodes.io, retrying network errors, 429s and 5xx
+    with exponential backoff (honouring Retry-After). Returns the result list,
+    or None if the chunk still failed.
+    """
+    for attempt in range(retries + 1):
+        try:
+            r = s.post(POSTCODES_IO_URL, json={"postcodes": chunk}, timeout=10)
+            if r.ok:
+                return r.json().get("result", [])
+            if r.status_code != 429 and r.status_code < 500:
+                # client error: retrying the same payload won't help
+                return None
+            retry_after = r.headers.get("Retry-After", "")
+        except (requests.RequestException, ValueError):
+            retry_after = ""
+        if attempt == retries:
+            break
+        wait = POSTCODES_IO_BACKOFF * (2 ** attempt)
+        if retry_after.isdigit():
+            wait = max(wait, int(retry_after))
+        if wait > POSTCODES_IO_MAX_WAIT:
+            # don't block the upload request; leave the chunk to the fallback
+            break
+        time.sleep(wait)
+    return None
+
+
+def _nominatim_fallback(postcodes):
+    """Geocode leftovers one at a time through get_coordinates, spaced to
+    respect Nominatim's usage policy across all requests (cache hits are not throttled).
+    """
+    global nominatim_last_call
+    out = {}
+    for pc in postcodes:
+        try:
+            if pc in geocode_cache:
+                coord = get_coordinates(pc)
+            else:
+                # hold the lock across the wait and the call so spacing is process-wide
+                with nominatim_lock:
+                    wait = NOMINATIM_MIN_INTERVAL - (time.monotonic() - nominatim_last_call)
+                    if wait > 0:
+                        time.sleep(wait)
+                    try:
+                        coord = get_coordinates(pc)
+                    finally:
+                        nominatim_last_call = time.monotonic()
+        except Exception:
+            # service errors / throttling: leave unresolved rather than fail the upload
+            continue
+        if coord:
+            out[pc] = coord
+    return out
+
+
+def fetch_postcodes_bulk(postcodes, max_workers=POSTCODES_IO_WORKERS, fallback=True, fallback_max=NOMINATIM_FALLBACK_MAX):
     """
-    postcodes: iterable of already-normalised strings
-    returns dict: { "SW1A 1AA": (lat, lon), ... }  (None if not found)
-    Uses Postcodes.io bulk endpoint (100/post).
+    postcodes: iterable of postcodes (normalised here); may combine several columns
+    returns dict: { "SW1A 1AA": (lat, lon), ... }  ((None, None) if not found)
+    Uses Postcodes.io bulk endpoint (100/post), chunks sent concurrently with retries;
+    up to fallback_max leftovers (None = all) go through the rate-limited Nominatim
+    fallback. Unresolved and skipped postcodes are logged; see _geocode_warning.
     """
     pcs = [p for p in map(_pc_norm, postcodes) if p]
     unique = sorted(set(pcs))
@@ -42,25 +153,148 @@ def fetch_postcodes_bulk(postcodes):
     if not unique:
         return out
 
-    url = "https://api.postcodes.io/postcodes"
-    s = requests.Session()
-    for i in range(0, len(unique), 100):
-        chunk = unique[i:i+100]
-        r = s.post(url, json={"postcodes": chunk}, timeout=10)
-        if not r.ok:
-            # be tolerant—skip this chunk rather than crash
-            continue
-        data = r.json()
-        for item in data.get("result", []):
-            q = item.get("query")
-            res = item.get("result")
-            if q and res:
-                out[q] = (res["latitude"], res["longitude"])
-            elif q:
-                out[q] = (None, None)
+    # reuse earlier lookups (shared with get_coordinates)
+    todo = []
+    for pc in unique:
+        if geocode_cache.get(pc):
+            out[pc] = geocode_cache[pc]
+        else:
+            todo.append(pc)
+
+    chunks = [todo[i:i+POSTCODES_IO_CHUNK] for i in range(0, len(todo), POSTCODES_IO_CHUNK)]
+    if chunks:
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        s.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for result in pool.map(lambda c: _post_postcodes_chunk(s, c), chunks):
+                for item in result or []:
+                    q = item.get("query")
+                    res = item.get("result")
+                    if q and res:
+                        out[q] = (res["latitude"], res["longitude"])
+                        geocode_cache[q] = out[q]
+
+    missing = [pc for pc in todo if pc not in out]
+    skipped = []
+    if fallback and missing:
+        tried = missing if fallback_max is None else missing[:fallback_max]
+        skipped = missing[len(tried):]
+        out.update(_nominatim_fallback(tried))
+    unresolved = [pc for pc in missing if pc not in out]
+    for pc in unresolved:
+        out[pc] = (None, None)
+    if unresolved:
+        app.logger.warning(
+            "Geocoding: %d of %d postcodes unresolved (%d skipped by fallback cap %s): %s",
+            len(unresolved), len(unique), len(skipped), fallback_max, ', '.join(unresolved[:20])
+        )
     return out
 
 
+def _geocode_warning(lookup):
+    """User-facing message for postcodes fetch_postcodes_bulk could not resolve (None if all did)."""
+    failed = sorted(pc for pc, coord in lookup.items() if not coord or coord[0] is None)
+    if not failed:
+        return None
+    sample = ', '.join(failed[:10]) + (', ...' if len(failed) > 10 else '')
+    return f"{len(failed)} of {len(lookup)} postcodes could not be geocoded and have no coordinates: {sample}"
+
+
+
+def _dataset_version(df):
+    """Content hash of an uploaded dataset; changes whenever a new upload differs."""
+    payload = df.to_json(orient='records', default_handler=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _stamp_dataset(kind, df):
+    """Record version + upload time for session['<kind>_data'] (used for ETag/Last-Modified)."""
+    session[f'{kind}_version'] = _dataset_version(df)
+    session[f'{kind}_updated'] = time.time()
+    # index now so the first click on any employee is a dict lookup
+    _cache_put((kind, session[f'{kind}_version']), _index_records(session[f'{kind}_data']),
+               record_index_cache, RECORD_INDEX_CACHE_MAX)
+
+
+def _index_records(records):
+    """{employee_number: record}; keeps the first row per employee, like the old DataFrame filter."""
+    index = {}
+    for r in records:
+        try:
+            index.setdefault(int(r['employee_number']), r)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return index
+
+
+def _session_record(kind, employee_number):
+    """Record for employee_number in session['<kind>_data'] (None if absent),
+    without rebuilding a DataFrame from the whole session on every request.
+    """
+    try:
+        number = int(employee_number)
+    except ValueError:
+        return None
+    version, _ = _session_dataset(kind)
+    index = _cache_get((kind, version), record_index_cache)
+    if index is None:
+        index = _cache_put((kind, version), _index_records(session[f'{kind}_data']),
+                           record_index_cache, RECORD_INDEX_CACHE_MAX)
+    return index.get(number)
+
+
+def _session_dataset(kind):
+    """Return (version, updated_ts) for session['<kind>_data'], stamping older sessions lazily."""
+    if f'{kind}_version' not in session:
+        _stamp_dataset(kind, pd.DataFrame(session[f'{kind}_data']))
+    return session[f'{kind}_version'], session[f'{kind}_updated']
+
+
+def _cache_get(key, cache=fragment_cache):
+    with cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(key, value, cache=fragment_cache, max_size=FRAGMENT_CACHE_MAX):
+    with cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+    return value
+
+
+def _conditional_response(body, mimetype, etag, updated):
+    """Serve a versioned payload: ETag/Last-Modified validators, 304 on a
+    matching conditional request, gzip when the client accepts it.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    use_gzip = len(body) >= 500 and bool(request.accept_encodings['gzip'])
+    if use_gzip:
+        gz = _cache_get(etag, gzip_cache)
+        if gz is None:
+            gz = _cache_put(etag, gzip.compress(body, compresslevel=6), gzip_cache)
+        body = gz
+        # distinct validator for the encoded representation
+        etag = etag + '-gz'
+    resp = Response(body, mimetype=mimetype)
+    if use_gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.set_etag(etag)
+    resp.last_modified = datetime.fromtimestamp(updated, tz=timezone.utc)
+    # data lives in the user's session: private, and always revalidate
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    resp.vary.add('Cookie')
+    resp.vary.add('Accept-Encoding')
+    return resp.make_conditional(request)
+
+
 def unpack_geom(g):
     if isinstance(g, str):
         try:
@@ -121,6 +355,111 @@ def get_driving_route(start_coord, end_coord):
     return None
 
 
+def _osrm_table_batch(origins, destinations):
+    """One OSRM /table call: durations (seconds) from each origin to each destination.
+    Returns a len(origins) x len(destinations) array (NaN where OSRM has no route),
+    or None if every server failed.
+    """
+    pts = list(destinations) + list(origins)
+    coords = ';'.join(f"{lon},{lat}" for lat, lon in pts)
+    n_dest = len(destinations)
+    params = {
+        'sources': ';'.join(str(i) for i in range(n_dest, len(pts))),
+        'destinations': ';'.join(str(i) for i in range(n_dest)),
+        'annotations': 'duration'
+    }
+    for base in OSRM_TABLE_URLS:
+        try:
+            resp = requests.get(base + coords, params=params, timeout=30)
+            if resp.status_code == 200:
+                data = resp.json()
+                if data.get('code') == 'Ok' and data.get('durations') is not None:
+                    return np.array(data['durations'], dtype=float)
+        except Exception:
+            continue
+    return None
+
+
+def fetch_table_durations(origins, destinations):
+    """Durations (seconds) from every origin to every destination, via batched
+    OSRM /table requests sent in parallel. Each batch carries all destinations
+    plus as many origins as fit under OSRM_TABLE_MAX_COORDS.
+    Returns (durations, complete); failed batches are NaN and make complete False.
+    """
+    destinations = list(destinations)
+    origins = list(origins)
+    if not origins or not destinations:
+        return np.full((len(origins), len(destinations)), np.nan), True
+    step = OSRM_TABLE_MAX_COORDS - len(destinations)
+    if step < 1:
+        raise ValueError(f'At most {OSRM_TABLE_MAX_COORDS - 1} destinations per table request')
+    chunks = [origins[i:i+step] for i in range(0, len(origins), step)]
+    with ThreadPoolExecutor(max_workers=OSRM_TABLE_WORKERS) as pool:
+        parts = list(pool.map(lambda c: _osrm_table_batch(c, destinations), chunks))
+    complete = all(p is not None for p in parts)
+    parts = [p if p is not None else np.full((len(c), len(destinations)), np.nan) for p, c in zip(parts, chunks)]
+    return np.vstack(parts), complete
+
+
+def compute_catchments(emp_df, version, dest_postcodes, bands=CATCHMENT_BANDS):
+    """Commute-time catchment for each candidate destination postcode.
+    Per-destination durations are cached under (version, postcode), so only
+    new sites hit OSRM; all uncached sites share one pass over employee homes.
+    Geocode misses and incomplete OSRM results are not cached, so they are retried.
+    """
+    dests = list(dict.fromkeys(p for p in map(_pc_norm, dest_postcodes) if p))
+    homes = emp_df.dropna(subset=['latitude', 'longitude'])
+    origins = list(zip(homes['latitude'].astype(float), homes['longitude'].astype(float)))
+
+    entries = {pc: _cache_get(('catchment', version, pc), catchment_cache) for pc in dests}
+    missing = [pc for pc, entry in entries.items() if entry is None]
+    if missing:
+        lookup = fetch_postcodes_bulk(missing)
+        located = []
+        for pc in missing:
+            coord = lookup.get(pc)
+            if coord and coord[0] is not None:
+                located.append((pc, coord))
+            else:
+                # may be a transient geocoder failure: report, don't cache
+                entries[pc] = {'coord': None, 'seconds': None}
+        if located:
+            table, complete = fetch_table_durations(origins, [c for _, c in located])
+            for j, (pc, coord) in enumerate(located):
+                entry = {'coord': coord, 'seconds': table[:, j], 'complete': complete}
+                if complete and (not origins or not np.isnan(entry['seconds']).all()):
+                    _cache_put(('catchment', version, pc), entry, catchment_cache, CATCHMENT_CACHE_MAX)
+                entries[pc] = entry
+
+    employee_numbers = homes['employee_number'].tolist()
+    results = []
+    for pc in dests:
+        entry = entries[pc]
+        if entry['coord'] is None:
+            results.append({'postcode': pc, 'error': 'not_found'})
+            continue
+        minutes = entry['seconds'] / 60.0
+        routed = ~np.isnan(minutes)
+        results.append({
+            'postcode': pc,
+            'lat': entry['coord'][0],
+            'lng': entry['coord'][1],
+            'employees': int(len(emp_df)),
+            'geocoded': int(len(homes)),
+            'routed': int(routed.sum()),
+            # False when some OSRM batches failed; counts are then lower bounds
+            'complete': entry['complete'],
+            'bands': {str(b): int(np.count_nonzero(minutes[routed] <= b)) for b in bands},
+            # one record per home (a list, so duplicate employee numbers are kept)
+            'durations': [
+                {'employee_number': int(e) if pd.notna(e) else None,
+                 'minutes': round(float(m), 1) if r else None}
+                for e, m, r in zip(employee_numbers, minutes, routed)
+            ]
+        })
+    return results
+
+
 def _append_message_listener_to_map(html_path):
         """Append a small JS listener to a saved folium HTML file so the parent page
         can postMessage commands to fly the map or draw a route.
@@ -188,6 +527,73 @@ def _append_message_listener_to_map(html_path):
                 # if anything goes wrong, ignore; map will still work but dynamic fly/show won't
                 pass
 
+def _outward_code(pcs):
+    """Vectorised outward code ("SW1A 1AA" -> "SW1A"); the inward code is always 3 chars."""
+    compact = pcs.astype('string').str.upper().str.replace(r'\s+', '', regex=True)
+    return compact.str[:-3].where(compact.str.len() > 3)
+
+
+def _describe(values, bins):
+    """Totals, percentiles and histogram for one numeric column (NaNs ignored)."""
+    v = values[~np.isnan(values)]
+    if v.size == 0:
+        return {'count': 0, 'total': 0.0, 'mean': None, 'min': None, 'max': None,
+                'percentiles': {}, 'histogram': {'edges': [], 'counts': []}}
+    counts, edges = np.histogram(v, bins=bins)
+    return {
+        'count': int(v.size),
+        'total': round(float(v.sum()), 2),
+        'mean': round(float(v.mean()), 2),
+        'min': round(float(v.min()), 2),
+        'max': round(float(v.max()), 2),
+        'percentiles': {f'p{p}': round(float(q), 2) for p, q in zip(ANALYTICS_PERCENTILES, np.percentile(v, ANALYTICS_PERCENTILES))},
+        'histogram': {'edges': np.round(edges, 2).tolist(), 'counts': counts.tolist()},
+    }
+
+
+def compute_commute_analytics(df, group_by=None, bins=10, days=WORKING_DAYS_PER_YEAR, co2_kg_per_mile=CO2_KG_PER_MILE):
+    """Aggregate route data (as produced by upload_route) without per-row Python loops.
+    group_by: None, 'district' (outward code of start_postcode) or 'destination' (end_postcode).
+    Annual figures assume one round trip per working day.
+    """
+    nan_col = pd.Series(np.nan, index=df.index)
+    dist = pd.to_numeric(df.get('distance_miles', nan_col), errors='coerce').to_numpy(dtype=float)
+    dur = pd.to_numeric(df.get('duration_hours', nan_col), errors='coerce').to_numpy(dtype=float)
+    annual_miles = dist * 2 * days
+    annual_co2 = annual_miles * co2_kg_per_mile
+
+    out = {
+        'employees': int(len(df)),
+        'routed': int(np.count_nonzero(~np.isnan(dist))),
+        'assumptions': {'working_days': days, 'co2_kg_per_mile': co2_kg_per_mile, 'round_trip': True},
+        'distance_miles': _describe(dist, bins),
+        'duration_hours': _describe(dur, bins),
+        'annual': {
+            'miles': round(float(np.nansum(annual_miles)), 1),
+            'co2_kg': round(float(np.nansum(annual_co2)), 1),
+        },
+    }
+
+    if group_by:
+        if group_by == 'district':
+            keys = _outward_code(df['start_postcode'])
+        else:
+            keys = df['end_postcode'].astype('string').str.strip().str.upper()
+        g = pd.DataFrame({'key': keys, 'distance': dist, 'duration': dur, 'annual_miles': annual_miles, 'annual_co2': annual_co2})
+        agg = g.groupby('key', dropna=True).agg(
+            employees=('key', 'size'),
+            mean_distance_miles=('distance', 'mean'),
+            median_distance_miles=('distance', 'median'),
+            mean_duration_hours=('duration', 'mean'),
+            annual_miles=('annual_miles', 'sum'),
+            annual_co2_kg=('annual_co2', 'sum'),
+        ).round(2).sort_values('employees', ascending=False)
+        out['group_by'] = group_by
+        # to_json handles numpy scalars and NaN -> null
+        out['groups'] = json.loads(agg.reset_index().to_json(orient='records'))
+    return out
+
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
@@ -226,6 +632,7 @@ def upload_file():
 
         # Save employee data to session
         session['employee_data'] = df.to_dict('records')
+        _stamp_dataset('employee', df)
         employee_numbers = df['employee_number'].dropna().unique().tolist()
 
         # Generate map of all employees
@@ -281,7 +688,7 @@ def upload_file():
                         continue
             except Exception:
                 route_coords = {}
-        return render_template('dashboard.html', map_url=map_url, employees=employees_list, route_employees=route_employees, employees_coords=employees_coords, route_coords=route_coords)
+        return render_template('dashboard.html', map_url=map_url, employees=employees_list, route_employees=route_employees, employees_coords=employees_coords, route_coords=route_coords, geocode_warning=_geocode_warning(lookup))
 
     # GET: show dashboard with current map if any
     map_url = None
@@ -382,16 +789,14 @@ def upload_route():
         if col not in df.columns:
             return f'Missing required column: {col}', 400
 
-    # Geocode start and end postcodes
-    # Bulk geocode start & end postcodes
+    # Bulk geocode start & end postcodes in one deduplicated pass
     df["start_pc_norm"] = df["start_postcode"].map(_pc_norm)
     df["end_pc_norm"]   = df["end_postcode"].map(_pc_norm)
 
-    start_lookup = fetch_postcodes_bulk(df["start_pc_norm"])
-    end_lookup   = fetch_postcodes_bulk(df["end_pc_norm"])
+    lookup = fetch_postcodes_bulk(pd.concat([df["start_pc_norm"], df["end_pc_norm"]]))
 
-    start_coords = df["start_pc_norm"].map(start_lookup)
-    end_coords   = df["end_pc_norm"].map(end_lookup)
+    start_coords = df["start_pc_norm"].map(lookup)
+    end_coords   = df["end_pc_norm"].map(lookup)
 
     df[["start_latitude","start_longitude"]] = pd.DataFrame(
         start_coords.apply(lambda t: t if t else (None, None)).tolist(),
@@ -547,6 +952,7 @@ def upload_route():
 
     # Save route data to session for later use
     session['route_data'] = df.to_dict('records')
+    _stamp_dataset('route', df)
     employee_numbers = df['employee_number'].dropna().unique().tolist()
     first_employee = employee_numbers[0] if employee_numbers else None
     # Generate map for first employee's route (if any)
@@ -555,10 +961,9 @@ def upload_route():
         m = folium.Map(location=[emp_row['start_latitude'], emp_row['start_longitude']], zoom_start=12)
         folium.Marker([emp_row['start_latitude'], emp_row['start_longitude']], popup='Start').add_to(m)
         folium.Marker([emp_row['end_latitude'], emp_row['end_longitude']], popup='End').add_to(m)
-        start = (emp_row['start_latitude'], emp_row['start_longitude'])
-        end = (emp_row['end_latitude'], emp_row['end_longitude'])
-        route = get_driving_route(start, end)
-        if route:
+        # geometry was already computed above; no second OSRM round-trip
+        route = unpack_geom(emp_row.get('route_geometry'))
+        if isinstance(route, list) and len(route) > 1:
             folium.PolyLine(route, color='blue', weight=5).add_to(m)
         else:
             folium.PolyLine([
@@ -617,20 +1022,23 @@ def upload_route():
         except Exception:
             continue
 
-    return render_template('dashboard.html', map_url=map_url, employees=employees_list, route_employees=route_employees_list, employees_coords=employees_coords, route_coords=route_coords)
+    return render_template('dashboard.html', map_url=map_url, employees=employees_list, route_employees=route_employees_list, employees_coords=employees_coords, route_coords=route_coords, geocode_warning=_geocode_warning(lookup))
 
 @app.route('/employee_map/<employee_number>')
 def employee_map(employee_number):
     if 'employee_data' not in session:
         return 'No employee data available. Please upload a file first.', 404
-    df = pd.DataFrame(session['employee_data'])
-    try:
-        employee_data = df[df['employee_number'] == int(employee_number)].iloc[0]
-    except (IndexError, ValueError):
-        return f'Employee {employee_number} not found', 404
-    m = folium.Map(location=[employee_data['latitude'], employee_data['longitude']], zoom_start=13)
-    folium.Marker([employee_data['latitude'], employee_data['longitude']], popup=f"Employee: {employee_data['employee_number']}<br>Postcode: {employee_data['postcode']}").add_to(m)
-    return Response(m._repr_html_(), mimetype='text/html')
+    version, updated = _session_dataset('employee')
+    key = ('employee_map', version, str(employee_number))
+    html = _cache_get(key)
+    if html is None:
+        employee_data = _session_record('employee', employee_number)
+        if employee_data is None:
+            return f'Employee {employee_number} not found', 404
+        m = folium.Map(location=[employee_data['latitude'], employee_data['longitude']], zoom_start=13)
+        folium.Marker([employee_data['latitude'], employee_data['longitude']], popup=f"Employee: {employee_data['employee_number']}<br>Postcode: {employee_data['postcode']}").add_to(m)
+        html = _cache_put(key, m._repr_html_())
+    return _conditional_response(html, 'text/html', f'{version}-emp-{employee_number}', updated)
 
 
 @app.route('/api/employee/<employee_number>')
@@ -651,22 +1059,75 @@ def api_employee(employee_number):
 def api_route(employee_number):
     if 'route_data' not in session:
         return jsonify({'error': 'no_route_data'}), 404
-    df = pd.DataFrame(session['route_data'])
+    version, updated = _session_dataset('route')
+    key = ('route_json', version, str(employee_number))
+    body = _cache_get(key)
+    if body is None:
+        emp = _session_record('route', employee_number)
+        if emp is None:
+            return jsonify({'error': 'not_found'}), 404
+        start_lat = emp.get('start_latitude')
+        start_lng = emp.get('start_longitude')
+        end_lat = emp.get('end_latitude')
+        end_lng = emp.get('end_longitude')
+        if pd.isna(start_lat) or pd.isna(start_lng) or pd.isna(end_lat) or pd.isna(end_lng):
+            return jsonify({'error': 'no_coordinates'}), 400
+        # serve the geometry upload_route already computed instead of calling OSRM live
+        route = unpack_geom(emp.get('route_geometry'))
+        if isinstance(route, list) and len(route) > 1:
+            payload = {'route': route}
+        else:
+            # fallback to start/end
+            payload = {'start': [float(start_lat), float(start_lng)], 'end': [float(end_lat), float(end_lng)]}
+        body = _cache_put(key, json.dumps(payload))
+    return _conditional_response(body, 'application/json', f'{version}-route-{employee_number}', updated)
+
+@app.route('/api/analytics')
+def api_analytics():
+    if 'route_data' not in session:
+        return jsonify({'error': 'no_route_data'}), 404
+    group_by = request.args.get('group_by') or None
+    if group_by not in (None, 'district', 'destination'):
+        return jsonify({'error': 'bad_group_by'}), 400
     try:
-        emp = df[df['employee_number'] == int(employee_number)].iloc[0]
-    except (IndexError, ValueError):
-        return jsonify({'error': 'not_found'}), 404
-    start_lat = emp.get('start_latitude')
-    start_lng = emp.get('start_longitude')
-    end_lat = emp.get('end_latitude')
-    end_lng = emp.get('end_longitude')
-    if pd.isna(start_lat) or pd.isna(start_lng) or pd.isna(end_lat) or pd.isna(end_lng):
-        return jsonify({'error': 'no_coordinates'}), 400
-    route = get_driving_route((start_lat, start_lng), (end_lat, end_lng))
-    if route:
-        return jsonify({'route': route})
-    # fallback to start/end
-    return jsonify({'start': [start_lat, start_lng], 'end': [end_lat, end_lng]})
+        bins = int(request.args.get('bins', 10))
+        days = float(request.args.get('days', WORKING_DAYS_PER_YEAR))
+        co2 = float(request.args.get('co2_kg_per_mile', CO2_KG_PER_MILE))
+    except ValueError:
+        return jsonify({'error': 'bad_parameter'}), 400
+    # comparisons are False for NaN, so this also rejects nan/inf
+    if not (1 <= bins <= 100 and 0 <= days <= MAX_WORKING_DAYS and 0 <= co2 <= MAX_CO2_KG_PER_MILE):
+        return jsonify({'error': 'bad_parameter'}), 400
+    version, updated = _session_dataset('route')
+    # aggregates are keyed by dataset version, so a new upload invalidates them
+    key = ('analytics', version, group_by, bins, days, co2)
+    body = _cache_get(key, analytics_cache)
+    if body is None:
+        result = compute_commute_analytics(pd.DataFrame(session['route_data']), group_by=group_by, bins=bins, days=days, co2_kg_per_mile=co2)
+        # allow_nan=False: never cache a body that isn't valid JSON
+        body = _cache_put(key, json.dumps(result, allow_nan=False), analytics_cache, ANALYTICS_CACHE_MAX)
+    etag = f'{version}-analytics-' + hashlib.sha1(repr(key[2:]).encode('utf-8')).hexdigest()[:8]
+    return _conditional_response(body, 'application/json', etag, updated)
+
+@app.route('/api/catchment')
+def api_catchment():
+    # ?postcode=AB1 2CD&postcode=... (or comma-separated), optional &bands=30,45,60 (minutes)
+    if 'employee_data' not in session:
+        return jsonify({'error': 'no_employee_data'}), 404
+    postcodes = [p for arg in request.args.getlist('postcode') for p in arg.split(',') if p.strip()]
+    if not postcodes:
+        return jsonify({'error': 'no_postcode'}), 400
+    if len(postcodes) > CATCHMENT_MAX_DESTINATIONS:
+        return jsonify({'error': 'too_many_postcodes', 'max': CATCHMENT_MAX_DESTINATIONS}), 400
+    try:
+        bands = sorted({int(b) for b in request.args.get('bands', ','.join(map(str, CATCHMENT_BANDS))).split(',') if b.strip()})
+    except ValueError:
+        return jsonify({'error': 'bad_bands'}), 400
+    if not bands or bands[0] <= 0:
+        return jsonify({'error': 'bad_bands'}), 400
+    version, _ = _session_dataset('employee')
+    emp_df = pd.DataFrame(session['employee_data'])
+    return jsonify({'bands': bands, 'destinations': compute_catchments(emp_df, version, postcodes, bands)})
 
 @app.route('/export_csv')
 def export_csv():
@@ -718,26 +1179,27 @@ def map_route(employee_number):
     # Show route for selected employee
     if 'route_data' not in session:
         return 'No route data available. Please upload a route file first.', 404
-    df = pd.DataFrame(session['route_data'])
-    try:
-        employee_data = df[df['employee_number'] == int(employee_number)].iloc[0]
-    except (IndexError, ValueError):
-        return f'Employee {employee_number} not found', 404
-    m = folium.Map(location=[employee_data['start_latitude'], employee_data['start_longitude']], zoom_start=12)
-    folium.Marker([employee_data['start_latitude'], employee_data['start_longitude']], popup='Start').add_to(m)
-    folium.Marker([employee_data['end_latitude'], employee_data['end_longitude']], popup='End').add_to(m)
-    # Try to get driving route
-    start = (employee_data['start_latitude'], employee_data['start_longitude'])
-    end = (employee_data['end_latitude'], employee_data['end_longitude'])
-    route = get_driving_route(start, end)
-    if route:
-        folium.PolyLine(route, color='blue', weight=5).add_to(m)
-    else:
-        folium.PolyLine([
-            [employee_data['start_latitude'], employee_data['start_longitude']],
-            [employee_data['end_latitude'], employee_data['end_longitude']]
-        ], color='gray', weight=3, dash_array='5').add_to(m)
-    return Response(m._repr_html_(), mimetype='text/html')
+    version, updated = _session_dataset('route')
+    key = ('route_map', version, str(employee_number))
+    html = _cache_get(key)
+    if html is None:
+        employee_data = _session_record('route', employee_number)
+        if employee_data is None:
+            return f'Employee {employee_number} not found', 404
+        m = folium.Map(location=[employee_data['start_latitude'], employee_data['start_longitude']], zoom_start=12)
+        folium.Marker([employee_data['start_latitude'], employee_data['start_longitude']], popup='Start').add_to(m)
+        folium.Marker([employee_data['end_latitude'], employee_data['end_longitude']], popup='End').add_to(m)
+        # Use the driving route stored at upload time
+        route = unpack_geom(employee_data.get('route_geometry'))
+        if isinstance(route, list) and len(route) > 1:
+            folium.PolyLine(route, color='blue', weight=5).add_to(m)
+        else:
+            folium.PolyLine([
+                [employee_data['start_latitude'], employee_data['start_longitude']],
+                [employee_data['end_latitude'], employee_data['end_longitude']]
+            ], color='gray', weight=3, dash_array='5').add_to(m)
+        html = _cache_put(key, m._repr_html_())
+    return _conditional_response(html, 'text/html', f'{version}-map-{employee_number}', updated)
 
 if __name__ == '__main__':
     app.run(debug=True)